@@ -1,5 +1,8 @@
+import json
+import math
+import os
 import sqlite3
-import logging
+import time
 from dataclasses import dataclass
 from datetime import datetime
 from typing import List, Tuple
@@ -7,16 +10,9 @@ from smoobu import Booking, BookingList
 from google_calendar import GoogleCalendarEvent
 from smoobu import Smoobu
 from google_calendar import GoogleCalendar
+from log import get_logger, Lazy
 
-logger = logging.getLogger("database")
-logger.setLevel(logging.INFO)
-file_handler = logging.FileHandler("app-database.log")
-console_handler = logging.StreamHandler()
-formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-file_handler.setFormatter(formatter)
-console_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
-logger.addHandler(console_handler)
+logger = get_logger("database")
 
 debug = False
 
@@ -26,18 +22,24 @@ class GoogleCalendarEvent:
     booking_id: int
     booking_modified_at: datetime
     event_id: str
+    arrival: datetime = None
+    apartment_id: int = None
 
 
 class Db:
     def __init__(self):
         try:
-            self.conn = sqlite3.connect("data.db")
+            # Several workers may share the database, wait for their locks
+            self.conn = sqlite3.connect(os.getenv("DB_PATH", "data.db"), timeout=30)
             self.cursor = self.conn.cursor()
+            self.cursor.execute("PRAGMA journal_mode=WAL")
             logger.info("Database connected")
         except sqlite3.Error as error:
-            logger.error(f"An error occurred: {error}")
+            logger.error("An error occurred: %s", error)
         # Create a table for the google calendar events to the booking id from the smoobu api
         try:
+            # Workers starting together must not both see a column as missing
+            self.cursor.execute("BEGIN IMMEDIATE")
             if debug:
                 query = """
                     CREATE TABLE IF NOT EXISTS google_calendar_events (
@@ -56,9 +58,59 @@ class Db:
                     )
                     """
             self.cursor.execute(query)
+            self._add_column_if_missing("arrival", "TEXT")
+            self._add_column_if_missing("payload", "TEXT")
+            self._add_column_if_missing("apartment_id", "INTEGER")
+            # Workers and the partitions of the bookings they have leased
+            self.cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS sync_workers (
+                    worker_id TEXT PRIMARY KEY,
+                    expires_at REAL NOT NULL,
+                    running_until REAL NOT NULL
+                )
+                """
+            )
+            self.cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS partition_leases (
+                    partition INTEGER PRIMARY KEY,
+                    worker_id TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+                """
+            )
             self.conn.commit()
-        except sqlite3.IntegrityError as error:
-            logger.error(f"An error occurred: {error}")
+        except sqlite3.Error as error:
+            self.conn.rollback()
+            logger.error("An error occurred: %s", error)
+
+    def _add_column_if_missing(self, column: str, column_type: str):
+        """
+        Add a column to the google_calendar_events table of an existing database,
+        must run inside the schema transaction
+        :param column: column name
+        :param column_type: sqlite column type
+        :return: None
+        """
+        self.cursor.execute("PRAGMA table_info(google_calendar_events)")
+        columns = {row[1] for row in self.cursor.fetchall()}
+        if column not in columns:
+            self.cursor.execute(
+                f"ALTER TABLE google_calendar_events ADD COLUMN {column} {column_type}"
+            )
+            logger.info("Added column %s to google_calendar_events", column)
+
+    @staticmethod
+    def _row_to_event(row) -> GoogleCalendarEvent:
+        booking_id, modified_at, event_id, arrival, apartment_id = row
+        return GoogleCalendarEvent(
+            booking_id,
+            datetime.strptime(modified_at, "%Y-%m-%d %H:%M:%S"),
+            event_id,
+            datetime.strptime(arrival, "%Y-%m-%d") if arrival else None,
+            apartment_id,
+        )
 
     def __enter__(self):
         return self
@@ -70,31 +122,42 @@ class Db:
             self.conn.close()
             logger.info("Database connection closed")
         except sqlite3.Error as error:
-            logger.error(f"Failed to close the database connection: {error}")
+            logger.error("Failed to close the database connection: %s", error)
 
     
-    def insert_google_calendar_event(self, booking: Booking, event: str):
+    def insert_google_calendar_event(self, booking: Booking, event: str, payload: dict = None):
         """
         Insert a google calendar event to the database
         :param booking: booking data
+        :param event: google calendar event id
+        :param payload: event body sent to google calendar
         :return: None
         """
         try:
             # Assuming booking.modified_at is a datetime object, convert to a string if needed
             modified_at_str = booking.modified_at.strftime('%Y-%m-%d %H:%M:%S')
-            logger.debug(f"Booking Id: {booking.id}\nModified at: {modified_at_str}\nEvent Id: {event}")
+            arrival_str = booking.arrival.strftime('%Y-%m-%d')
+            logger.debug("Booking Id: %s\nModified at: %s\nEvent Id: %s", booking.id, modified_at_str, event)
             self.cursor.execute(
-                f"""
-                INSERT INTO google_calendar_events (booking_id, booking_modified_at, event_id)
-                VALUES ({booking.id}, '{modified_at_str}', '{event}')
                 """
+                INSERT INTO google_calendar_events (booking_id, booking_modified_at, event_id, arrival, payload, apartment_id)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    booking.id,
+                    modified_at_str,
+                    event,
+                    arrival_str,
+                    json.dumps(payload) if payload is not None else None,
+                    booking.apartment.id,
+                ),
             )
-            logger.debug(f"Event inserted: {booking.id}")
+            logger.debug("Event inserted: %s", booking.id)
             self.conn.commit()
         except sqlite3.IntegrityError as error:
-            logger.error(f"An error occurred: {error} with booking id: {booking.id}")
+            logger.error("An error occurred: %s with booking id: %s", error, booking.id)
         except sqlite3.InterfaceError as error:
-            logger.error(f"Interface error occurred: {error} with booking id: {booking.id}")
+            logger.error("Interface error occurred: %s with booking id: %s", error, booking.id)
 
 
     def delete_google_calendar_event(self, booking_id: int):
@@ -111,10 +174,10 @@ class Db:
                 """,
                 (booking_id,),
             )
-            logger.debug(f"Event deleted: {booking_id}")
+            logger.debug("Event deleted: %s", booking_id)
             self.conn.commit()
         except sqlite3.Error as error:
-            logger.error(f"An error occurred: {error}")
+            logger.error("An error occurred: %s", error)
 
     def is_modified(self, booking_id: str, booking_modified_at: datetime):
         """
@@ -134,28 +197,95 @@ class Db:
             result = self.cursor.fetchone()
             return result
         except sqlite3.Error as error:
-            logger.error(f"An error occurred: {error}")
+            logger.error("An error occurred: %s", error)
 
-    def update_modified_at(self, booking_id: str, booking_modified_at: datetime):
+    def update_modified_at(
+        self,
+        booking_id: str,
+        booking_modified_at: datetime,
+        arrival: datetime = None,
+        payload: dict = None,
+    ):
         """
         Update the modified_at field in the database
         :param booking_id: booking id
         :param booking_modified_at: booking modified at
+        :param arrival: new arrival date of the booking, kept unchanged if None
+        :param payload: event body last sent to google calendar, kept unchanged if None
         :return: None
         """
         try:
             modified_at_str = booking_modified_at.strftime('%Y-%m-%d %H:%M:%S')
+            arrival_str = arrival.strftime('%Y-%m-%d') if arrival else None
+            payload_str = json.dumps(payload) if payload is not None else None
             self.cursor.execute(
-                f"""
+                """
                 UPDATE google_calendar_events
-                SET booking_modified_at = '{modified_at_str}'
-                WHERE booking_id = '{booking_id}'
+                SET booking_modified_at = ?,
+                    arrival = COALESCE(?, arrival),
+                    payload = COALESCE(?, payload)
+                WHERE booking_id = ?
+                """,
+                (modified_at_str, arrival_str, payload_str, booking_id),
+            )
+            logger.debug("Modified at updated: %s", booking_id)
+            self.conn.commit()
+        except sqlite3.Error as error:
+            logger.error("An error occurred: %s", error)
+
+    def backfill_bookings(self, bookings: List[Booking]):
+        """
+        Store the arrival and apartment of the bookings on their rows, so rows
+        written before they were tracked are prioritised, partitioned and
+        deleted correctly once cancelled
+        :param bookings: list of bookings
+        :return: None
+        """
+        try:
+            rows = []
+            for booking in bookings:
+                arrival_str = booking.arrival.strftime('%Y-%m-%d')
+                rows.append(
+                    (
+                        arrival_str,
+                        booking.apartment.id,
+                        booking.id,
+                        arrival_str,
+                        booking.apartment.id,
+                    )
+                )
+            self.cursor.executemany(
                 """
+                UPDATE google_calendar_events
+                SET arrival = ?, apartment_id = ?
+                WHERE booking_id = ? AND (arrival IS NOT ? OR apartment_id IS NOT ?)
+                """,
+                rows,
             )
-            logger.debug(f"Modified at updated: {booking_id}")
+            logger.debug("Backfilled %s rows", self.cursor.rowcount)
             self.conn.commit()
         except sqlite3.Error as error:
-            logger.error(f"An error occurred: {error}")
+            logger.error("An error occurred: %s", error)
+
+    def get_payload(self, booking_id: int) -> dict:
+        """
+        Get the event body last sent to google calendar for the booking
+        :param booking_id: booking id
+        :return: event body, None if unknown
+        """
+        try:
+            self.cursor.execute(
+                """
+                SELECT payload FROM google_calendar_events
+                WHERE booking_id = ?
+                """,
+                (booking_id,),
+            )
+            result = self.cursor.fetchone()
+            if result and result[0]:
+                return json.loads(result[0])
+        except sqlite3.Error as error:
+            logger.error("An error occurred: %s", error)
 
     def get_all(self):
         """
@@ -180,28 +310,34 @@ class Db:
         """
         try:
             if not bookings:
-                query = "SELECT * FROM google_calendar_events"
+                query = "SELECT booking_id, booking_modified_at, event_id, arrival, apartment_id FROM google_calendar_events"
                 self.cursor.execute(query)
-                results = self.cursor.fetchall()
-                logger.debug(f"Total events: {len(results)}")
+                results = [self._row_to_event(row) for row in self.cursor.fetchall()]
+                logger.debug("Total events: %s", len(results))
                 return results, []
             else:
                 # Get booking IDs from the list of bookings
                 booking_ids = [booking.id for booking in bookings]
 
                 placeholders = ", ".join(["?"] * len(booking_ids))
-                query = f"SELECT * FROM google_calendar_events WHERE booking_id NOT IN ({placeholders})"
+                query = f"""
+                    SELECT booking_id, booking_modified_at, event_id, arrival, apartment_id
+                    FROM google_calendar_events WHERE booking_id NOT IN ({placeholders})
+                    """
                 self.cursor.execute(query, booking_ids)
-                database_events_not_in_bookings = self.cursor.fetchall()
+                database_events_not_in_bookings = [
+                    self._row_to_event(row) for row in self.cursor.fetchall()
+                ]
                 logger.debug(
-                    f"Total database events not in bookings: {len(database_events_not_in_bookings)}"
+                    "Total database events not in bookings: %s",
+                    len(database_events_not_in_bookings),
                 )
 
                 # Now, find bookings that are not in the database
                 query = "SELECT booking_id FROM google_calendar_events"
                 self.cursor.execute(query)
                 existing_booking_ids = {row[0] for row in self.cursor.fetchall()}
-                logger.debug(f"The booking ids in the database: {existing_booking_ids}")
+                logger.debug("The booking ids in the database: %s", existing_booking_ids)
 
                 bookings_not_in_database = [
                     booking
@@ -209,14 +345,132 @@ class Db:
                     if booking.id not in existing_booking_ids
                 ]
                 logger.debug(
-                    f"The bookings not in the database: {[booking.id for booking in bookings_not_in_database]}"
+                    "The bookings not in the database: %s",
+                    Lazy(lambda: [booking.id for booking in bookings_not_in_database]),
                 )
 
                 return database_events_not_in_bookings, bookings_not_in_database
         except sqlite3.Error as error:
-            logger.error(f"get_entries_not_in_list: {error}")
+            logger.error("get_entries_not_in_list: %s", error)
             return [], []
 
+    def claim_partitions(self, worker_id: str, partitions: int, ttl: float) -> List[int]:
+        """
+        Lease this worker's share of the partitions. Leases held by the worker are
+        renewed, partitions of workers that stopped renewing are taken over and
+        surplus partitions are released once more workers are alive.
+        :param worker_id: id of the worker
+        :param partitions: total number of partitions
+        :param ttl: seconds until the leases and the worker heartbeat expire
+        :return: leased partitions, empty if another run of this worker is still active
+        """
+        now = time.time()
+        try:
+            self.conn.commit()
+            self.cursor.execute("BEGIN IMMEDIATE")
+            self.cursor.execute(
+                "SELECT running_until FROM sync_workers WHERE worker_id = ?",
+                (worker_id,),
+            )
+            row = self.cursor.fetchone()
+            if row and row[0] > now:
+                self.conn.rollback()
+                logger.warning("Worker %s is already running", worker_id)
+                return []
+            self.cursor.execute(
+                """
+                INSERT OR REPLACE INTO sync_workers (worker_id, expires_at, running_until)
+                VALUES (?, ?, ?)
+                """,
+                (worker_id, now + ttl, 0),
+            )
+            self.cursor.execute("DELETE FROM sync_workers WHERE expires_at < ?", (now,))
+            self.cursor.execute("DELETE FROM partition_leases WHERE expires_at < ?", (now,))
+            self.cursor.execute("SELECT COUNT(*) FROM sync_workers")
+            target = math.ceil(partitions / self.cursor.fetchone()[0])
+
+            self.cursor.execute("SELECT partition, worker_id FROM partition_leases")
+            leases = dict(self.cursor.fetchall())
+            owned = sorted(p for p, owner in leases.items() if owner == worker_id and p < partitions)
+            free = [p for p in range(partitions) if p not in leases]
+            claimed = (owned + free)[:target]
+            released = [p for p in owned if p not in claimed]
+
+            self.cursor.executemany(
+                "DELETE FROM partition_leases WHERE partition = ?",
+                [(p,) for p in released],
+            )
+            self.cursor.executemany(
+                """
+                INSERT OR REPLACE INTO partition_leases (partition, worker_id, expires_at)
+                VALUES (?, ?, ?)
+                """,
+                [(p, worker_id, now + ttl) for p in claimed],
+            )
+            if claimed:
+                # Only a worker with partitions to sync is running
+                self.cursor.execute(
+                    "UPDATE sync_workers SET running_until = ? WHERE worker_id = ?",
+                    (now + ttl, worker_id),
+                )
+            self.conn.commit()
+            logger.info("Worker %s leased partitions %s", worker_id, claimed)
+            return claimed
+        except sqlite3.Error as error:
+            self.conn.rollback()
+            logger.error("claim_partitions: %s", error)
+            return []
+
+    def renew_leases(self, worker_id: str, partitions: List[int], ttl: float) -> bool:
+        """
+        Extend the leases of the worker while it is still syncing
+        :param worker_id: id of the worker
+        :param partitions: partitions leased by claim_partitions
+        :param ttl: seconds until the leases and the worker heartbeat expire
+        :return: True if all leases are still held, False if any expired
+        """
+        now = time.time()
+        try:
+            placeholders = ", ".join(["?"] * len(partitions))
+            self.cursor.execute(
+                f"""
+                UPDATE partition_leases SET expires_at = ?
+                WHERE worker_id = ? AND expires_at >= ? AND partition IN ({placeholders})
+                """,
+                (now + ttl, worker_id, now, *partitions),
+            )
+            renewed = self.cursor.rowcount
+            self.cursor.execute(
+                """
+                UPDATE sync_workers SET expires_at = ?, running_until = ?
+                WHERE worker_id = ?
+                """,
+                (now + ttl, now + ttl, worker_id),
+            )
+            self.conn.commit()
+            if renewed < len(partitions):
+                logger.warning("Worker %s lost the lease of its partitions", worker_id)
+                return False
+            return True
+        except sqlite3.Error as error:
+            logger.error("renew_leases: %s", error)
+            return False
+
+    def finish_run(self, worker_id: str):
+        """
+        Mark the run of the worker as finished, its leases are kept until they expire
+        :param worker_id: id of the worker
+        :return: None
+        """
+        try:
+            self.cursor.execute(
+                "UPDATE sync_workers SET running_until = 0 WHERE worker_id = ?",
+                (worker_id,),
+            )
+            self.conn.commit()
+        except sqlite3.Error as error:
+            logger.error("An error occurred: %s", error)
+
     def delete_google_calendar_entries(self):
         """
         Delete all the google calendar entries from the database
@@ -235,7 +489,7 @@ class Db:
                 google_calendar.delete_google_calendar_event(entry)
             self.conn.commit()
         except sqlite3.Error as error:
-            logger.error(f"An error occurred: {error}")
+            logger.error("An error occurred: %s", error)
 
 
 if __name__ == "__main__":
@@ -3,10 +3,11 @@ from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 from dotenv import load_dotenv
 from typing import List
+import base64
+import hashlib
 import pickle
 import os
 import json
-import logging
 import time
 
 from google.auth.transport.requests import Request
@@ -15,18 +16,64 @@ from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
-logger = logging.getLogger("google_calendar")
-logger.setLevel(logging.INFO)
-file_handler = logging.FileHandler("app-google-calendar.log")
-console_handler = logging.StreamHandler()
-formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-file_handler.setFormatter(formatter)
-console_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
-logger.addHandler(console_handler)
+from log import get_logger
+
+logger = get_logger("google_calendar")
 
 load_dotenv()
 
+NUM_RETRIES = int(os.getenv("GOOGLE_NUM_RETRIES", 3))
+
+
+QUOTA_REASONS = ("rateLimitExceeded", "userRateLimitExceeded", "quotaExceeded")
+
+
+class QuotaExceededError(Exception):
+    """Raised when google calendar rejects a call because of quota or rate limits"""
+
+
+def raise_for_quota(error: HttpError):
+    """
+    Raise QuotaExceededError if the error is caused by quota or rate limits
+    :param error: error of a google calendar call
+    :return: None
+    """
+    content = error.content
+    if isinstance(content, bytes):
+        content = content.decode(errors="replace")
+    if error.resp.status == 429 or (
+        error.resp.status == 403 and any(reason in content for reason in QUOTA_REASONS)
+    ):
+        raise QuotaExceededError(str(error)) from error
+
+
+def event_id_for_booking(booking_id: int) -> str:
+    """
+    Derive the google calendar event id from the smoobu booking id. The id is a
+    base32hex encoded hash, which only uses the characters a-v and 0-9 accepted
+    by the calendar api, so creating the same booking twice conflicts instead of
+    creating a duplicate.
+    :param booking_id: smoobu booking id
+    :return: google calendar event id
+    """
+    digest = hashlib.sha1(f"smoobu-booking-{booking_id}".encode()).digest()
+    return base64.b32hexencode(digest).decode().rstrip("=").lower()
+
+
+def diff_event_payload(previous: dict, current: dict) -> dict:
+    """
+    Get the top level fields of an event body that changed
+    :param previous: event body last sent to google calendar
+    :param current: new event body
+    :return: changed fields with their new value, removed fields set to None
+    """
+    changes = {
+        key: value for key, value in current.items() if previous.get(key) != value
+    }
+    for key in previous.keys() - current.keys():
+        changes[key] = None
+    return changes
+
 
 @dataclass
 class EventTime:
@@ -110,7 +157,7 @@ class GoogleCalendar:
             with open(token_path, "rb") as token:
                 self.creds = pickle.load(token)
         else:
-            logger.error(f"Token file {token_path} not found.")
+            logger.error("Token file %s not found.", token_path)
             raise Exception("Token file not found.")
 
         if not self.creds or not self.creds.valid:
@@ -125,61 +172,98 @@ class GoogleCalendar:
         try:
             self.service = build("calendar", "v3", credentials=self.creds)
         except HttpError as error:
-            logger.error(f"An error occurred: {error}")
+            logger.error("An error occurred: %s", error)
             raise error
 
-    def create_google_calendar_event(self, event: GoogleCalendarEvent) -> str:
+    def create_google_calendar_event(
+        self, event: GoogleCalendarEvent, event_id: str = None
+    ) -> str:
+        """
+        Create a google calendar event for the booking. With a fixed event id the
+        call is idempotent: if the event already exists it is updated instead.
+        :param event: google calendar event
+        :param event_id: event id, see event_id_for_booking, None lets google assign one
+        :return: event id, None on error
+        """
+        body = event.to_dict()
+        if event_id is not None:
+            body["id"] = event_id
+        try:
+            logger.debug("Event: %s", body)
+            created = (
+                self.service.events()
+                .insert(calendarId="primary", body=body)
+                .execute(num_retries=NUM_RETRIES)
+            )
+            logger.info("Event created: %s", created.get("htmlLink"))
+            return created.get("id")
+        except HttpError as error:
+            if error.resp.status == 409 and event_id is not None:
+                logger.info("Event %s already exists, updating it", event_id)
+                # A previously deleted event keeps its id, confirm it to restore it
+                body["status"] = "confirmed"
+                return self._update(event_id, body)
+            raise_for_quota(error)
+            logger.error("An error occurred: %s", error)
+
+    def _update(self, event_id: str, body: dict) -> str:
         """
-        Create a google calendar event for the booking
-        :param booking_id: booking id
-        :param booking_data: booking data
-        :return: None
+        Replace a google calendar event with the given body
+        :param event_id: google calendar event id
+        :param body: full event body
+        :return: event id, None on error
         """
         try:
-            logger.debug(f"Event: {event.to_dict()}")
             event = (
                 self.service.events()
-                .insert(calendarId="primary", body=event.to_dict())
-                .execute()
+                .update(calendarId="primary", eventId=event_id, body=body)
+                .execute(num_retries=NUM_RETRIES)
             )
-            logger.info(f'Event created: {event.get("htmlLink")}')
+            logger.info("Event updated: %s", event.get("htmlLink"))
             return event.get("id")
         except HttpError as error:
-            logger.error(f"An error occurred: {error}")
+            raise_for_quota(error)
+            logger.error("An error occurred: %s", error)
 
-    def update_google_calendar_event(self, event_id: str, event: GoogleCalendarEvent):
+    def patch_google_calendar_event(self, event_id: str, fields: dict) -> str:
         """
-        Update a google calendar event for the booking
-        :param booking_id: booking id
-        :param booking_data: booking data
-        :return: None
+        Update only the given fields of a google calendar event
+        :param event_id: google calendar event id
+        :param fields: changed fields, see diff_event_payload
+        :return: event id, None on error
         """
         try:
-            logger.debug(f"Event: {event.to_dict()}")
+            logger.debug("Patch %s: %s", event_id, fields)
             event = (
                 self.service.events()
-                .update(calendarId="primary", eventId=event_id, body=event.to_dict())
-                .execute()
+                .patch(calendarId="primary", eventId=event_id, body=fields)
+                .execute(num_retries=NUM_RETRIES)
             )
-            logger.info(f'Event updated: {event.get("htmlLink")}')
+            logger.info("Event patched: %s", event.get("htmlLink"))
             return event.get("id")
         except HttpError as error:
-            logger.error(f"An error occurred: {error}")
+            raise_for_quota(error)
+            logger.error("An error occurred: %s", error)
 
-    def delete_google_calendar_event(self, event_id: str):
+    def delete_google_calendar_event(self, event_id: str) -> bool:
         """
         Delete a google calendar event for the booking
-        :param booking_id: booking id
-        :param booking_data: booking data
-        :return: None
+        :param event_id: google calendar event id
+        :return: True if the event is gone, False otherwise
         """
         try:
             self.service.events().delete(
                 calendarId="primary", eventId=event_id
-            ).execute()
-            logger.info(f"Event deleted: {event_id}")
+            ).execute(num_retries=NUM_RETRIES)
+            logger.info("Event deleted: %s", event_id)
+            return True
         except HttpError as error:
-            logger.error(f"An error occurred: {error}")
+            if error.resp.status in (404, 410):
+                logger.info("Event already deleted: %s", event_id)
+                return True
+            raise_for_quota(error)
+            logger.error("An error occurred: %s", error)
+            return False
 
 
 if __name__ == "__main__":
@@ -0,0 +1,98 @@
+from dotenv import load_dotenv
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+
+load_dotenv()
+
+_listener: QueueListener = None
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "name": record.name,
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class _QueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """
+        Render the message in the calling thread, where the arguments are still
+        current, but keep exc_info so the listener's formatter renders the traceback
+        :param record: log record
+        :return: record to put on the queue
+        """
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class Lazy:
+    """
+    Defer an expensive log argument until the record is actually formatted
+    :param func: callable producing the value to log
+    """
+
+    def __init__(self, func):
+        self.func = func
+
+    def __str__(self):
+        return str(self.func())
+
+
+def setup_logging():
+    """
+    Attach a single queue handler to the root logger. The file and console
+    handlers run on a background listener thread, so logging calls never
+    block the sync loop on I/O.
+    :return: None
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    if os.getenv("LOG_FORMAT", "text").lower() == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(
+            "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+        )
+    file_handler = RotatingFileHandler(
+        os.getenv("LOG_FILE", "app.log"),
+        maxBytes=int(os.getenv("LOG_MAX_BYTES", 5 * 1024 * 1024)),
+        backupCount=int(os.getenv("LOG_BACKUP_COUNT", 3)),
+    )
+    console_handler = logging.StreamHandler()
+    file_handler.setFormatter(formatter)
+    console_handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+    root.addHandler(_QueueHandler(log_queue))
+
+    _listener = QueueListener(log_queue, file_handler, console_handler)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+
+def get_logger(name: str) -> logging.Logger:
+    """
+    Get a logger that writes through the shared queue
+    :param name: logger name
+    :return: logger
+    """
+    setup_logging()
+    return logging.getLogger(name)
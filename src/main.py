@@ -1,4 +1,3 @@
-import logging
 import os
 from typing import List
 from smoobu import Smoobu, Booking
@@ -9,18 +8,15 @@ from google_calendar import (
     EventReminder,
     EventReminderOverride,
     GoogleCalendar,
+    event_id_for_booking,
+    diff_event_payload,
 )
-from database import Db
-
-logger = logging.getLogger("main")
-logger.setLevel(logging.INFO)
-file_handler = logging.FileHandler("app-main.log")
-console_handler = logging.StreamHandler()
-formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-file_handler.setFormatter(formatter)
-console_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
-logger.addHandler(console_handler)
+from database import Db, GoogleCalendarEvent as CalendarEntry
+from scheduler import MutationQueue
+from partition import PARTITIONS, LEASE_TTL, WORKER_ID, partition_of
+from log import get_logger
+
+logger = get_logger("main")
 
 def create_calendar_event(booking: Booking):
     event = GoogleCalendarEvent(
@@ -36,72 +32,148 @@ def create_calendar_event(booking: Booking):
     )
     return event
 
-def create_and_insert_google_calendar_events(bookings: List[Booking], db: Db):
+def create_and_insert_google_calendar_events(
+    bookings: List[Booking], db: Db, google_calendar: GoogleCalendar, queue: MutationQueue
+):
     """
-    Create and insert google calendar events to the database
+    Schedule the creation of google calendar events and their insertion to the database
     :param bookings: list of bookings
     :return: None
     """
-    google_calendar = GoogleCalendar()
     for booking in bookings:
-        event = create_calendar_event(booking)
-        event_id = google_calendar.create_google_calendar_event(event)
-        if event_id is None:
-            return
-        db.insert_google_calendar_event(booking, event_id)
+
+        def create(booking=booking):
+            event = create_calendar_event(booking)
+            event_id = google_calendar.create_google_calendar_event(
+                event, event_id_for_booking(booking.id)
+            )
+            if event_id is None:
+                return False
+            db.insert_google_calendar_event(booking, event_id, event.to_dict())
+            return True
+
+        queue.push("create", booking.id, booking.arrival, create)
 
 
-def delete_google_calendar_events(bookings: List[GoogleCalendarEvent], db: Db):
+def delete_google_calendar_events(
+    entries: List[CalendarEntry], db: Db, google_calendar: GoogleCalendar, queue: MutationQueue
+):
     """
-    Delete the google calendar events from the database
-    :param bookings: list of bookings
+    Schedule the deletion of the google calendar events from the database.
+    Only upcoming stays are removed from the calendar, past stays are kept as history.
+    :param entries: list of database entries without a booking
     :return: None
     """
-    google_calendar = GoogleCalendar()
-    for booking in bookings:
-        # google_calendar.delete_google_calendar_event(booking.id)
-        db.delete_google_calendar_event(booking.id)
+    for entry in entries:
 
-def check_modified_bookings(bookings: List[Booking], db: Db):
+        def delete(entry=entry):
+            if entry.arrival and entry.arrival.date() >= queue.today:
+                if not google_calendar.delete_google_calendar_event(entry.event_id):
+                    return False
+            db.delete_google_calendar_event(entry.booking_id)
+            return True
+
+        queue.push("delete", entry.booking_id, entry.arrival, delete)
+
+def check_modified_bookings(
+    bookings: List[Booking], db: Db, google_calendar: GoogleCalendar, queue: MutationQueue
+):
     """
-    Check if the bookings are modified in the database
+    Schedule the update of the bookings that are modified in the database
     :param bookings: list of bookings
     :return: None
     """
-    google_calendar = GoogleCalendar()
-    with Db() as db:
-        for booking in bookings:
-            calender_event_id = db.is_modified(booking.id, booking.modified_at)
-            if calender_event_id:
-                event = create_calendar_event(booking)
-                google_calendar.update_google_calendar_event(
-                    calender_event_id[0], event
-                )
-                db.update_modified_at(booking.id, booking.modified_at)
-                print(f"Booking {calender_event_id[0]} is modified")
-                logger.info(f"Booking {booking.id} is modified")
+    for booking in bookings:
+        calender_event_id = db.is_modified(booking.id, booking.modified_at)
+        if not calender_event_id:
+            continue
+
+        def update(booking=booking, event_id=calender_event_id[0]):
+            payload = create_calendar_event(booking).to_dict()
+            previous = db.get_payload(booking.id)
+            if previous is None:
+                # No payload stored for events created before it was tracked
+                result = google_calendar.patch_google_calendar_event(event_id, payload)
+            else:
+                changes = diff_event_payload(previous, payload)
+                if not changes:
+                    logger.info("Booking %s is modified but its event is unchanged", booking.id)
+                    db.update_modified_at(booking.id, booking.modified_at, booking.arrival)
+                    return True
+                result = google_calendar.patch_google_calendar_event(event_id, changes)
+            if result is None:
+                return False
+            db.update_modified_at(booking.id, booking.modified_at, booking.arrival, payload)
+            logger.info("Booking %s is modified", booking.id)
+            return True
+
+        queue.push("update", booking.id, booking.arrival, update)
 
 
 
 def sync_smoobu_to_google_calendar():
     logger.info("Starting the sync")
-    bookings = Smoobu().get_smoobu_reservations()
+    smoobu = Smoobu()
+    bookings = smoobu.get_smoobu_reservations()
+    if bookings is None:
+        logger.error("No bookings received from Smoobu, skipping the sync")
+        return
+    # Bookings missing from an incomplete listing would look cancelled
+    listing_size = len(bookings)
+    listing_complete = listing_size > 0 and listing_size >= smoobu.total_items
+    google_calendar = GoogleCalendar()
+    queue = MutationQueue()
     with Db() as db:
-        (
-            database_events_not_in_bookings,
-            bookings_not_in_database_events,
-        ) = db.get_entries_not_in_list(bookings)
-        logger.debug(f"Number of bookings not in the database: {len(bookings_not_in_database_events)}")
-        logger.debug(f"Number of database events not in bookings: {len(database_events_not_in_bookings)}")
-        if bookings_not_in_database_events:
-            create_and_insert_google_calendar_events(
-                bookings_not_in_database_events, db
-            )
-        if database_events_not_in_bookings:
-            delete_google_calendar_events(database_events_not_in_bookings, db)
-        check_modified_bookings(bookings, db)
+        # An idle worker is not marked as running, only finish runs that got partitions
+        partitions = db.claim_partitions(WORKER_ID, PARTITIONS, LEASE_TTL)
+        if not partitions:
+            logger.info("Worker %s has no partitions to sync", WORKER_ID)
+            return
+        try:
+            (
+                database_events_not_in_bookings,
+                bookings_not_in_database_events,
+            ) = db.get_entries_not_in_list(bookings)
+            # The difference is taken over all bookings, then limited to our partitions
+            bookings = [
+                booking
+                for booking in bookings
+                if partition_of(booking.id, booking.apartment.id) in partitions
+            ]
+            bookings_not_in_database_events = [
+                booking
+                for booking in bookings_not_in_database_events
+                if partition_of(booking.id, booking.apartment.id) in partitions
+            ]
+            database_events_not_in_bookings = [
+                entry
+                for entry in database_events_not_in_bookings
+                if partition_of(entry.booking_id, entry.apartment_id) in partitions
+            ]
+            db.backfill_bookings(bookings)
+            logger.debug("Number of bookings not in the database: %s", len(bookings_not_in_database_events))
+            logger.debug("Number of database events not in bookings: %s", len(database_events_not_in_bookings))
+            if bookings_not_in_database_events:
+                create_and_insert_google_calendar_events(
+                    bookings_not_in_database_events, db, google_calendar, queue
+                )
+            if database_events_not_in_bookings and not listing_complete:
+                logger.warning(
+                    "Smoobu returned %s of %s bookings, skipping %s deletions",
+                    listing_size,
+                    smoobu.total_items,
+                    len(database_events_not_in_bookings),
+                )
+            elif database_events_not_in_bookings:
+                delete_google_calendar_events(
+                    database_events_not_in_bookings, db, google_calendar, queue
+                )
+            check_modified_bookings(bookings, db, google_calendar, queue)
+            # Keep the leases for as long as the run takes
+            queue.run(lambda: db.renew_leases(WORKER_ID, partitions, LEASE_TTL))
+        finally:
+            db.finish_run(WORKER_ID)
 
 
 if __name__ == "__main__":
-    logger.setLevel(logging.DEBUG)
     sync_smoobu_to_google_calendar()
@@ -0,0 +1,33 @@
+from dotenv import load_dotenv
+import os
+import socket
+import zlib
+
+load_dotenv()
+
+PARTITIONS = int(os.getenv("SYNC_PARTITIONS", 1))
+# "booking" hashes the booking id, "apartment" keeps all bookings of an apartment together
+PARTITION_BY = os.getenv("SYNC_PARTITION_BY", "booking")
+LEASE_TTL = float(os.getenv("SYNC_LEASE_TTL", 120))
+WORKER_ID = os.getenv("SYNC_WORKER_ID") or socket.gethostname()
+
+# Workers disagreeing on the partitioning could both sync the same booking
+if PARTITIONS < 1:
+    raise ValueError(f"SYNC_PARTITIONS must be at least 1, got {PARTITIONS}")
+if PARTITION_BY not in ("booking", "apartment"):
+    raise ValueError(
+        f'SYNC_PARTITION_BY must be "booking" or "apartment", got "{PARTITION_BY}"'
+    )
+
+
+def partition_of(booking_id: int, apartment_id: int = None) -> int:
+    """
+    Get the partition a booking belongs to
+    :param booking_id: booking id
+    :param apartment_id: apartment id of the booking, None if unknown
+    :return: partition number
+    """
+    key = booking_id
+    if PARTITION_BY == "apartment" and apartment_id is not None:
+        key = apartment_id
+    return zlib.crc32(str(key).encode()) % PARTITIONS
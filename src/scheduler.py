@@ -0,0 +1,141 @@
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta
+from zoneinfo import ZoneInfo
+from dotenv import load_dotenv
+from typing import Callable, List
+import heapq
+import itertools
+import os
+import time
+
+from google_calendar import QuotaExceededError
+from log import get_logger
+
+load_dotenv()
+
+logger = get_logger("scheduler")
+
+URGENT = 0
+UPCOMING = 1
+PAST = 2
+UNKNOWN = 3
+
+
+@dataclass(order=True)
+class Mutation:
+    priority: tuple
+    sequence: int
+    kind: str = field(compare=False)
+    booking_id: int = field(compare=False)
+    job: Callable[[], bool] = field(compare=False)
+
+
+class MutationQueue:
+    """
+    Priority queue of calendar mutations ordered by the booking arrival.
+    Mutations that are not executed within the time budget are simply dropped:
+    they are derived from the difference between Smoobu and the database, so
+    the next run finds and schedules them again.
+    """
+
+    def __init__(self, time_budget: float = None, near_term_days: int = None):
+        if time_budget is None:
+            time_budget = float(os.getenv("SYNC_TIME_BUDGET", 50))
+        if near_term_days is None:
+            near_term_days = int(os.getenv("SYNC_NEAR_TERM_DAYS", 2))
+        self.time_budget = time_budget
+        self.near_term = timedelta(days=near_term_days)
+        self.today = self._today()
+        self._heap: List[Mutation] = []
+        self._counter = itertools.count()
+
+    @staticmethod
+    def _today() -> date:
+        time_zone = os.getenv("TIME_ZONE")
+        if time_zone:
+            return datetime.now(ZoneInfo(time_zone)).date()
+        return date.today()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def priority(self, kind: str, arrival: datetime) -> tuple:
+        """
+        Priority of a mutation, lower runs first
+        :param kind: "create", "update" or "delete"
+        :param arrival: arrival of the booking, None if unknown
+        :return: sortable priority tuple
+        """
+        if arrival is None:
+            return (UNKNOWN, 0)
+        arrival_date = arrival.date()
+        if arrival_date == self.today:
+            return (URGENT, arrival.timestamp())
+        if kind == "delete" and self.today <= arrival_date <= self.today + self.near_term:
+            return (URGENT, arrival.timestamp())
+        if arrival_date > self.today:
+            return (UPCOMING, arrival.timestamp())
+        # Most recent past stays first, old history last
+        return (PAST, -arrival.timestamp())
+
+    def push(self, kind: str, booking_id: int, arrival: datetime, job: Callable[[], bool]):
+        """
+        Schedule a mutation
+        :param kind: "create", "update" or "delete"
+        :param booking_id: booking id
+        :param arrival: arrival of the booking, None if unknown
+        :param job: callable doing the mutation, returns False if it failed
+        :return: None
+        """
+        heapq.heappush(
+            self._heap,
+            Mutation(self.priority(kind, arrival), next(self._counter), kind, booking_id, job),
+        )
+
+    def run(self, keep_alive: Callable[[], bool] = None) -> int:
+        """
+        Execute the mutations in priority order until the queue is empty,
+        the time budget is spent or the calendar quota is exceeded. Other
+        failed mutations are skipped and retried on the next run
+        :param keep_alive: called before each mutation, returns False to stop the run
+        :return: number of executed mutations
+        """
+        deadline = time.monotonic() + self.time_budget
+        executed = 0
+        failed = 0
+        while self._heap:
+            if time.monotonic() >= deadline:
+                logger.warning(
+                    "Time budget of %ss spent, %s mutations carried over to the next run",
+                    self.time_budget,
+                    len(self._heap),
+                )
+                break
+            if keep_alive is not None and not keep_alive():
+                logger.warning(
+                    "Run stopped, %s mutations carried over to the next run",
+                    len(self._heap),
+                )
+                break
+            mutation = heapq.heappop(self._heap)
+            logger.debug("Running %s for booking %s", mutation.kind, mutation.booking_id)
+            try:
+                succeeded = mutation.job()
+            except QuotaExceededError as error:
+                logger.warning(
+                    "Quota exceeded (%s), %s mutations carried over to the next run",
+                    error,
+                    len(self._heap) + 1,
+                )
+                break
+            if succeeded is False:
+                logger.warning(
+                    "%s for booking %s failed, retrying it on the next run",
+                    mutation.kind,
+                    mutation.booking_id,
+                )
+                failed += 1
+                continue
+            executed += 1
+        logger.info("Executed %s mutations, %s failed", executed, failed)
+        return executed
@@ -8,17 +8,11 @@ import logging
 # how to import List
 from typing import List
 
+from log import get_logger
+
 load_dotenv()
 
-logger = logging.getLogger("smoobu")
-logger.setLevel(logging.INFO)
-file_handler = logging.FileHandler("app-smoobu.log")
-console_handler = logging.StreamHandler()
-formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-file_handler.setFormatter(formatter)
-console_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
-logger.addHandler(console_handler)
+logger = get_logger("smoobu")
 
 
 @dataclass
@@ -129,11 +123,14 @@ class Smoobu:
     def __init__(self):
         self.api_key = os.getenv("SMOOBU_API")
         self.headers = {"Api-Key": self.api_key, "Cache-Control": "no-cache"}
+        self.total_items = None
 
     def get_smoobu_reservations(self) -> List[Booking]:
         """
-        Get the data from smoobu api
-        :return: list of dict
+        Get the data from smoobu api. total_items is set to the number of
+        bookings smoobu reports, which is more than the returned bookings
+        if a page could not be loaded.
+        :return: list of unique bookings, None if the first page fails
         """
         response = requests.get(
             "https://login.smoobu.com/api/reservations",
@@ -142,26 +139,33 @@ class Smoobu:
         if response.status_code == 200:
             data = response.json()
             booking_list = BookingList.from_json(data)
-            # make a function that goes through the pages and gets all the bookings
+            self.total_items = booking_list.total_items
             bookings = booking_list.bookings
-            for page in range(1, booking_list.page_count):
+            # The first request returns page 1, pages are numbered from 1
+            for page in range(2, booking_list.page_count + 1):
                 response = requests.get(
                     f"https://login.smoobu.com/api/reservations?page={page}",
                     headers=self.headers,
                 )
+                if response.status_code != 200:
+                    logger.error("Error: %s on page %s", response.status_code, page)
+                    break
                 data = response.json()
                 booking_list = BookingList.from_json(data)
                 bookings.extend(booking_list.bookings)
-                logger.debug(f"Page {page} of {booking_list.page_count} loaded")
-            if booking_list.total_items > len(bookings):
+                logger.debug("Page %s of %s loaded", page, booking_list.page_count)
+            # Bookings may move between pages while paging, keep each once
+            bookings = list({booking.id: booking for booking in bookings}.values())
+            if self.total_items > len(bookings):
                 logger.warning(
-                    f"Total bookings: {booking_list.total_items} is greater than the number of bookings returned: {len(bookings)}"
+                    "Total bookings: %s is greater than the number of bookings returned: %s",
+                    self.total_items,
+                    len(bookings),
                 )
-            logger.info(f"Total bookings: {len(bookings)}")
+            logger.info("Total bookings: %s", len(bookings))
             return bookings
         elif response.status_code != 200:
-            logger.error(f"Error: {response.status_code}")
-
+            logger.error("Error: %s", response.status_code)
 
 if __name__ == "__main__":
     logger.setLevel(logging.DEBUG)